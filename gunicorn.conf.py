@@ -0,0 +1,16 @@
+import multiprocessing, os
+
+# /chat spends almost all of its time waiting on OpenAI, so run threaded
+# workers: one process keeps serving other learners while a call is in flight.
+bind         = f"0.0.0.0:{os.getenv('PORT', '8080')}"
+# CPUs this process may actually run on (like nproc); cpu_count() counts every host CPU
+try:
+    _cpus = len(os.sched_getaffinity(0))
+except AttributeError:  # no sched_getaffinity on macOS/Windows
+    _cpus = multiprocessing.cpu_count()
+workers      = int(os.getenv("WEB_CONCURRENCY", _cpus))
+worker_class = "gthread"
+threads      = int(os.getenv("GUNICORN_THREADS", "16"))
+timeout      = 120
+# import main.py (UI bytes, gzip blob) once in the master; the OpenAI client is still built per worker
+preload_app  = True
@@ -1,14 +1,17 @@
-import os, re
-from flask import Flask, request, jsonify
+import base64, gzip, hashlib, hmac, os, threading, time
+from collections import OrderedDict
+import orjson
+from flask import Flask, Response, request
 from dotenv import load_dotenv
-from openai import OpenAI
+from werkzeug.exceptions import RequestEntityTooLarge
 
 load_dotenv()
 app = Flask(__name__)
+app.config["MAX_CONTENT_LENGTH"] = 20 * 1024 * 1024  # hard cap on any request body
 
 # ---------- CONFIG ----------
 def strip_ws(s: str) -> str:
-    return re.sub(r"\s+", "", s or "")
+    return "".join((s or "").split())  # str.split() drops all Unicode whitespace, no regex needed
 
 OPENAI_API_KEY = strip_ws(os.getenv("OPENAI_API_KEY", ""))
 if not OPENAI_API_KEY:
@@ -16,8 +19,31 @@ if not OPENAI_API_KEY:
 MODEL    = os.getenv("OPENAI_MODEL", "gpt-4o-mini")  # vision-capable
 PASSWORD = os.getenv("MATHMATE_PASSWORD", "unlock-mathmate")
 DEBUG    = os.getenv("DEBUG", "0") == "1"
-
-client = OpenAI(api_key=OPENAI_API_KEY)
+PASSWORD_BYTES = PASSWORD.encode("utf-8")
+PASSWORD_LOWER = PASSWORD.lower().encode("utf-8")  # the typed unlock password is case-insensitive
+MAX_IMAGES = 4  # images per /chat call; all go into one vision request
+UNLOCK_MAX_BYTES = 4096  # an unlock attempt is just the password; anything bigger is refused unparsed
+
+# openai (httpx, pydantic, ...) is imported on first /chat so cold starts and /health stay fast
+client = None
+_client_lock = threading.Lock()  # gthread workers may hit the first /chat from several threads at once
+
+def get_client():
+    global client
+    if client is None:
+        with _client_lock:
+            if client is None:
+                import httpx
+                from openai import DefaultHttpxClient, OpenAI
+                # keep idle TLS connections to the API alive between a learner's turns
+                client = OpenAI(
+                    api_key=OPENAI_API_KEY,
+                    timeout=60.0,
+                    http_client=DefaultHttpxClient(
+                        limits=httpx.Limits(max_connections=100, max_keepalive_connections=50, keepalive_expiry=120.0),
+                    ),
+                )
+    return client
 
 # ---------- PROMPT (grounded; confirm-first for vision) ----------
 MATHMATE_PROMPT = r"""
@@ -77,236 +103,205 @@ HARD_CONSTRAINT = (
     "(Apprentice step-by-step; Rising Hero brief+question; Master single short question)."
 )
 
+# invariant system prefix, built once as a single message; kept byte-identical and first so OpenAI prompt caching can reuse it
+BASE_SYSTEM = (
+    {"role": "system", "content": MATHMATE_PROMPT.strip() + "\n\n" + HARD_CONSTRAINT},
+)
+
+# per-turn system lines: the fixed wording lives here, chat() only fills in the blanks
+GRADE_LINE = "GRADE={grade} for tone. Use Grade Guide; simplify language for younger grades and increase rigor for older grades."
+FOCUS_LINE = (
+    "Focus Anchor: {focus} "
+    "Stay on this focus; do not switch topics unless the learner clearly starts a new problem or says 'new question/new problem'."
+)
+# Vision guard: MUST confirm read pairs first when images are present
+VISION_GUARD = (
+    "VISION GUARD: An image is present. Your FIRST reply must ONLY restate the (x,y) pairs you can read "
+    "for any table/option you will discuss, in this exact compact format, without calculations: "
+    "\"Read pairs → A: (x1,y1); (x2,y2); (x3,y3) | B: ... | C: ... . Confirm Y/N?\" "
+    "If any value is uncertain, use '?' and ask the learner to type it. Do not proceed to math until the learner confirms."
+)
+
+# level -> (system line, max_tokens); reply sized by level so it doesn't cut off mid-list
+LEVELS = {
+    "apprentice": (
+        "LEVEL=Apprentice. You may explain proactively (2–6 short sentences) and must include a guiding question or options.",
+        260,
+    ),
+    "rising hero": (
+        "LEVEL=Rising Hero. Brief coaching allowed (≤2 short sentences) plus one guiding question or options. Total 1–3 sentences.",
+        180,
+    ),
+    "master": (
+        "LEVEL=Master. No explanations unless asked. One concise guiding question only.",
+        120,
+    ),
+}
+LEVEL_DEFAULT = ("", 120)
+
+# ---------- REPLY CACHE (identical prompts skip the OpenAI round-trip) ----------
+REPLY_CACHE_MAX = 1024
+REPLY_CACHE_TTL = 300  # seconds; a stale hint is worse than one extra API call
+REPLY_CACHE_SWEEP_EVERY = 256  # puts between sweeps that drop expired entries nobody asked for again
+_reply_puts  = 0
+_reply_cache = OrderedDict()  # blake2b(model, max_tokens, messages) -> (stored_at, reply), LRU order
+_reply_lock  = threading.Lock()
+
+def reply_key(messages, max_out) -> bytes:
+    return hashlib.blake2b(orjson.dumps([MODEL, max_out, messages]), digest_size=16).digest()
+
+def cache_get(key):
+    if key is None:
+        return None
+    with _reply_lock:
+        hit = _reply_cache.get(key)
+        if hit is None:
+            return None
+        if time.monotonic() - hit[0] > REPLY_CACHE_TTL:
+            del _reply_cache[key]
+            return None
+        _reply_cache.move_to_end(key)
+        return hit[1]
+
+def cache_put(key, reply):
+    global _reply_puts
+    if key is None or not reply:
+        return
+    now = time.monotonic()
+    with _reply_lock:
+        _reply_puts += 1
+        if _reply_puts % REPLY_CACHE_SWEEP_EVERY == 0:
+            cutoff = now - REPLY_CACHE_TTL
+            for k in [k for k, (stored_at, _) in _reply_cache.items() if stored_at < cutoff]:
+                del _reply_cache[k]
+        _reply_cache[key] = (now, reply)
+        _reply_cache.move_to_end(key)
+        if len(_reply_cache) > REPLY_CACHE_MAX:
+            _reply_cache.popitem(last=False)
+
 # ---------- HEALTH ----------
 @app.get("/health")
 def health():
     return "ok", 200
 
-# ---------- UI (same merged input card) ----------
+# ---------- UI (same merged input card; markup in templates/index.html, never served raw) ----------
+with open(os.path.join(app.root_path, "templates", "index.html"), encoding="utf-8") as f:
+    HOME_HTML = f.read()
+HOME_BYTES = HOME_HTML.replace("{{MAX_IMAGES}}", str(MAX_IMAGES)).encode("utf-8")  # encoded once; reused by every GET /
+HOME_GZ    = gzip.compress(HOME_BYTES, compresslevel=9)
+HOME_ETAG  = hashlib.blake2b(HOME_BYTES, digest_size=8).hexdigest()  # changes whenever the page does
+
 @app.get("/")
 def home():
-    return """
-<!doctype html>
-<meta charset="utf-8" />
-<title>🔒 MathMate Pro</title>
-
-<!-- MathJax for pretty fractions/equations -->
-<script>
-window.MathJax = { tex: { inlineMath: [['$', '$'], ['\\\\(', '\\\\)']] }, svg: { fontCache: 'global' } };
-</script>
-<script src="https://cdn.jsdelivr.net/npm/mathjax@3/es5/tex-svg.js" async></script>
-
-<style>
-  :root{--bg:#fff;--text:#0f172a;--muted:#64748b;--line:#e2e8f0;--me:#e6f0ff;--bot:#f8fafc;--accent:#111827}
-  *{box-sizing:border-box}
-  body{margin:0;background:var(--bg);color:var(--text);font-family:system-ui,Segoe UI,Roboto,Helvetica,Arial}
-
-  header{position:sticky;top:0;background:var(--bg);border-bottom:1px solid var(--line);padding:12px 16px;z-index:10;text-align:center}
-  h1{margin:0;font-size:22px;letter-spacing:.2px}
-
-  main{display:flex;justify-content:center}
-  .wrap{width:100%;max-width:1400px;padding:16px}
-
-  #chat{min-height:52vh;max-height:64vh;overflow:auto;padding:12px 4px}
-  .row{display:flex;margin:10px 0}
-  .bubble{max-width:78%;padding:12px 14px;border:1px solid var(--line);border-radius:16px;line-height:1.55;white-space:pre-wrap}
-  .me{justify-content:flex-end}
-  .me .bubble{background:var(--me)}
-  .bot{justify-content:flex-start}
-  .bot .bubble{background:var(--bot)}
-  .sys{color:var(--muted);text-align:center;font-style:italic}
-
-  #panel{position:sticky;bottom:0;background:var(--bg);padding:14px 0;border-top:1px solid var(--line)}
-  #unlock{display:flex;gap:8px}
-  input,button,select,textarea{font:inherit}
-  input,select{padding:10px 12px;border-radius:12px;border:1px solid var(--line);background:#fff;color:var(--text)}
-  button{padding:12px 16px;border-radius:12px;border:1px solid var(--line);background:var(--accent);color:#fff;cursor:pointer;min-width:84px}
-  button:disabled{opacity:.6;cursor:not-allowed}
-
-  #composer{display:none;align-items:stretch;gap:12px}
-  .inputCard{flex:1;border:1px solid var(--line);border-radius:16px;background:#fff;display:flex;flex-direction:column;overflow:hidden;transition:box-shadow .2s,border-color .2s}
-  .inputCard.drag{border-color:#60a5fa;box-shadow:0 0 0 3px rgba(96,165,250,.25)}
-  .inputHeader{display:flex;gap:16px;align-items:center;justify-content:flex-start;padding:10px 12px;border-bottom:1px solid var(--line);background:#f9fafb}
-  .inputHeader label{display:flex;align-items:center;gap:8px;color:var(--text)}
-  .inputArea{padding:10px}
-  textarea{width:100%;min-height:150px;max-height:360px;resize:vertical;padding:14px;border-radius:12px;border:1px solid var(--line);outline:none;background:#fff;color:#0f172a}
-  .inputFooter{border-top:1px dashed var(--line);padding:10px;display:flex;align-items:center;gap:10px;flex-wrap:wrap}
-  .addBtn{display:inline-flex;align-items:center;gap:8px;padding:8px 12px;border:1px dashed var(--line);border-radius:12px;color:var(--muted);background:#fff;cursor:pointer}
-  .thumbs{display:flex;gap:8px;flex-wrap:wrap}
-  .thumb{width:72px;height:72px;border:1px solid var(--line);border-radius:8px;background:#fff;display:flex;align-items:center;justify-content:center;overflow:hidden}
-  .thumb img{max-width:100%;max-height:100%}
-  .sendCol{display:flex;align-items:flex-end}
-</style>
-
-<header><h1>🔒 MathMate Pro</h1></header>
-
-<main><div class="wrap">
-  <div id="chat"><div class="sys">Type the password to unlock.</div></div>
-
-  <div id="panel">
-    <div id="unlock">
-      <input id="password" placeholder="Type the password to unlock." style="flex:1" />
-      <button id="unlockBtn">Unlock</button>
-    </div>
-
-    <div id="composer">
-      <div class="inputCard" id="inputCard">
-        <div class="inputHeader">
-          <label>Grade:
-            <select id="grade">
-              <option value="K">K</option>
-              <option>1</option><option>2</option><option>3</option><option>4</option><option>5</option>
-              <option selected>6</option><option>7</option><option>8</option><option>9</option><option>10</option>
-              <option>11</option><option>12</option>
-            </select>
-          </label>
-          <label>Level:
-            <select id="level">
-              <option selected>Apprentice</option>
-              <option>Rising Hero</option>
-              <option>Master</option>
-            </select>
-          </label>
-        </div>
-
-        <div class="inputArea">
-          <textarea id="msg" placeholder="Type here and drag/drop or paste images into this box. (Shift+Enter = newline)"></textarea>
-          <input id="fileBtn" type="file" accept="image/*" multiple style="display:none" />
-        </div>
-
-        <div class="inputFooter">
-          <button id="addBtn" class="addBtn" type="button">➕ Add images</button>
-          <div id="thumbs" class="thumbs"></div>
-        </div>
-      </div>
-
-      <div class="sendCol">
-        <button id="sendBtn">Send</button>
-      </div>
-    </div>
-  </div>
-</div></main>
-
-<script>
-const chat = document.getElementById('chat');
-const unlock = document.getElementById('unlock');
-const composer = document.getElementById('composer');
-const inputCard = document.getElementById('inputCard');
-const msgBox = document.getElementById('msg');
-const pwdBox = document.getElementById('password');
-const unlockBtn = document.getElementById('unlockBtn');
-const sendBtn = document.getElementById('sendBtn');
-const fileBtn = document.getElementById('fileBtn');
-const addBtn = document.getElementById('addBtn');
-const thumbs = document.getElementById('thumbs');
-const levelSel = document.getElementById('level');
-const gradeSel = document.getElementById('grade');
-
-let AUTH=''; let LEVEL=levelSel.value; let GRADE=gradeSel.value; let CURRENT=1; let FOCUS=''; let lastBot=''; let queuedImages=[];
-let HIST=[]; // rolling short history (text only)
-
-function typeset(row){ if(window.MathJax?.typesetPromise){ window.MathJax.typesetPromise([row]).catch(()=>{}); } }
-
-function addBubble(who,text){
-  const content=(text||'').trim();
-  if(who==='MathMate'){
-    const prev=(lastBot||'').trim();
-    if(prev && (content===prev || (content.length>20 && prev.length>20 && content.startsWith(prev.slice(0,Math.min(40,prev.length)))))) return;
-    lastBot=content;
-    HIST.push({role:'assistant', content}); HIST=HIST.slice(-6);
-  }else{
-    HIST.push({role:'user', content}); HIST=HIST.slice(-6);
-  }
-  const row=document.createElement('div'); row.className=who==='You'?'row me':'row bot';
-  const bbl=document.createElement('div'); bbl.className='bubble'; bbl.innerHTML=content.replace(/</g,'&lt;');
-  row.appendChild(bbl); chat.appendChild(row); chat.scrollTop=chat.scrollHeight; if(who==='MathMate') typeset(row);
-}
+    gz = request.accept_encodings["gzip"] > 0  # quality-aware: "gzip;q=0" means no
+    etag = HOME_ETAG + "-gz" if gz else HOME_ETAG
+    headers = {"Cache-Control": "public, max-age=3600", "Vary": "Accept-Encoding", "ETag": f'"{etag}"'}
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers=headers)
+    if gz:
+        headers["Content-Encoding"] = "gzip"
+        return Response(HOME_GZ, mimetype="text/html", headers=headers)
+    return Response(HOME_BYTES, mimetype="text/html", headers=headers)
 
-function looksLikeProblem(t){const has=/\\d/.test(t||'');const long=(t||'').length>=16;const math=/(total|difference|sum|product|quotient|fraction|percent|rate|area|perimeter|slope|graph|table|equation|x|y)/i.test(t||'');return (has&&long)||math;}
-function updateFocus(text,imgCount){
-  if(/\\bnew question\\b|\\bnext question\\b/i.test(text||'')){ CURRENT=Math.max(1,CURRENT+1); return; }
-  if(/\\bnew problem\\b/i.test(text||'')){ FOCUS=''; return; }
-  if(imgCount>0){ FOCUS='(image problem)'; return; }
-  if(looksLikeProblem(text)){ FOCUS=text.slice(0,300); }
-}
+# ---------- CHAT (vision + meta + anchor) ----------
+LOCKED_REPLY = "🔒 Please type the access password to begin."
 
-async function post(payload){
-  const r=await fetch('/chat',{
-    method:'POST',
-    headers:{'Content-Type':'application/json','X-Auth':AUTH},
-    body:JSON.stringify({ ...payload, level:LEVEL, grade:GRADE, current:CURRENT, focus:FOCUS, history:HIST })
-  });
-  return r.json();
-}
+def json_reply(**fields):
+    return Response(orjson.dumps(fields), mimetype="application/json")
 
-function addThumb(src){ const d=document.createElement('div'); d.className='thumb'; const img=document.createElement('img'); img.src=src; d.appendChild(img); thumbs.appendChild(d); }
-async function filesToDataURLs(files){
-  for(const f of files){ if(!f.type.startsWith('image/')) continue;
-    const fr=new FileReader(); const p=new Promise((res,rej)=>{fr.onload=()=>res(fr.result);fr.onerror=rej;}); fr.readAsDataURL(f);
-    const url=await p; queuedImages.push(url); addThumb(url);
-  }
-}
+@app.errorhandler(RequestEntityTooLarge)
+def too_large(e):
+    # JSON like every other /chat outcome, so the UI can show it instead of choking on an HTML page
+    return json_reply(error="That upload is too large. Try fewer or smaller images."), 413
 
-addBtn.onclick=()=>fileBtn.click();
-fileBtn.onchange=async (e)=>{ await filesToDataURLs(e.target.files); fileBtn.value=''; };
-
-['dragenter','dragover'].forEach(ev=> inputCard.addEventListener(ev,(e)=>{ e.preventDefault(); inputCard.classList.add('drag'); }));
-['dragleave','dragend','drop'].forEach(ev=> inputCard.addEventListener(ev,(e)=>{ e.preventDefault(); inputCard.classList.remove('drag'); }));
-inputCard.addEventListener('drop', async (e)=>{ await filesToDataURLs(e.dataTransfer.files); });
-
-msgBox.addEventListener('paste', async (e)=>{
-  const items=e.clipboardData?.items; if(!items) return;
-  const files=[]; for(const it of items){ if(it.type && it.type.startsWith('image/')) files.push(it.getAsFile()); }
-  if(files.length){ e.preventDefault(); await filesToDataURLs(files); }
-});
-
-unlockBtn.onclick=async ()=>{
-  const pw=(pwdBox.value||'').trim(); if(!pw) return;
-  addBubble('You','••••••••');
-  const data=await post({message:pw});
-  addBubble('MathMate', data.reply ?? data.error ?? '(error)');
-  if((data.reply||'').startsWith('🔓')){ AUTH=pw; unlock.style.display='none'; composer.style.display='flex'; msgBox.focus(); }
-};
-
-levelSel.onchange=()=>{ LEVEL=levelSel.value; };
-gradeSel.onchange=()=>{ GRADE=gradeSel.value; };
-
-sendBtn.onclick=async ()=>{
-  const text=(msgBox.value||'').trim(); if(!text && queuedImages.length===0) return;
-  updateFocus(text, queuedImages.length);
-  addBubble('You', text || '(image(s) only)'); msgBox.value=''; sendBtn.disabled=true;
-  try{
-    const data=await post({message:text,images:queuedImages});
-    addBubble('MathMate',(data.reply ?? data.error ?? '(error)'));
-  }finally{
-    sendBtn.disabled=false; queuedImages=[]; thumbs.innerHTML=''; msgBox.focus();
-  }
-};
-
-msgBox.addEventListener('keydown',(e)=>{ if(e.key==='Enter' && !e.shiftKey){ e.preventDefault(); sendBtn.click(); }});
-pwdBox.addEventListener('keydown',(e)=>{ if(e.key==='Enter'){ e.preventDefault(); unlockBtn.click(); }});
-</script>
-"""
+def read_json():
+    # orjson parses the (possibly multi-MB, base64-image) body faster than the stdlib path behind get_json
+    try:
+        return orjson.loads(request.get_data(cache=False)) if request.content_length else {}
+    except orjson.JSONDecodeError:
+        return {}
+
+def read_payload():
+    # the UI posts multipart: JSON fields in "payload" plus raw image parts, base64-encoded once here;
+    # a plain JSON body with data-URL "images" is still accepted
+    if request.mimetype != "multipart/form-data":
+        return read_json()
+    try:
+        p = orjson.loads(request.form.get("payload") or "{}")
+    except orjson.JSONDecodeError:
+        p = {}
+    p["images"] = [
+        f"data:{f.mimetype};base64,{base64.b64encode(f.read()).decode('ascii')}"
+        for f in request.files.getlist("images")
+        if f.mimetype.startswith("image/")
+    ]
+    return p
+
+def complete(messages, max_out, stream=False):
+    return get_client().chat.completions.create(
+        model=MODEL,
+        temperature=0.0,   # reduce randomness—no invented numbers
+        frequency_penalty=0.5,
+        presence_penalty=0.2,
+        max_tokens=max_out,
+        messages=messages,
+        stream=stream,
+    )
+
+STREAM_FLUSH_SECS = 0.05
+
+def sse(data) -> bytes:
+    return b"data: " + orjson.dumps(data) + b"\n\n"
+
+def stream_reply(key, messages, max_out, cached):
+    # runs after chat() has returned, so it reports its own errors as an SSE event;
+    # deltas are for live display, the closing {"final": ...} event is the reply of record
+    if cached is not None:
+        yield sse({"final": cached})
+        return
+    parts, sent, last_flush = [], 0, 0.0
+    try:
+        for chunk in complete(messages, max_out, stream=True):
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if delta:
+                parts.append(delta)
+                # coalesce tokens: at most one write per STREAM_FLUSH_SECS (the first token goes out at once)
+                now = time.monotonic()
+                if now - last_flush >= STREAM_FLUSH_SECS:
+                    yield sse({"delta": "".join(parts[sent:])})
+                    sent, last_flush = len(parts), now
+    except Exception as e:
+        err = f"{type(e).__name__}: {e}"
+        app.logger.exception("Chat stream crashed: %s", err)
+        yield sse({"error": err if DEBUG else "Server error"})
+        return
+    reply = "".join(parts)
+    cache_put(key, reply)
+    yield sse({"final": reply})
 
-# ---------- CHAT (vision + meta + anchor) ----------
 @app.post("/chat")
 def chat():
     try:
-        p = request.get_json(silent=True) or {}
-
+        # --- SAFE UNLOCK (before the body is parsed: locked clients never get an image payload decoded) ---
+        if not hmac.compare_digest(request.headers.get("X-Auth", "").encode("utf-8"), PASSWORD_BYTES):
+            if (request.content_length or 0) > UNLOCK_MAX_BYTES:
+                return json_reply(reply=LOCKED_REPLY), 401
+            text = str(read_json().get("message", "") or "").strip()
+            if hmac.compare_digest(text.lower().encode("utf-8"), PASSWORD_LOWER):
+                return json_reply(reply="🔓 Unlocked! Pick your grade & level, then send your problem or a photo. ✨"), 200
+            return json_reply(reply=LOCKED_REPLY), 200
+
+        p = read_payload()
         text     = str(p.get("message", "") or "").strip()
-        images   = (p.get("images") or [])[:4]
+        images   = p.get("images") or []
         level    = str(p.get("level", "") or "").strip()
         grade    = str(p.get("grade", "") or "").strip()
         current  = str(p.get("current", "") or "").strip()
         focus    = str(p.get("focus", "") or "").strip()
         history  = p.get("history") or []
 
-        # --- SAFE UNLOCK ---
-        if request.headers.get("X-Auth", "") != PASSWORD:
-            if text.lower() == PASSWORD.lower():
-                return jsonify(reply="🔓 Unlocked! Pick your grade & level, then send your problem or a photo. ✨"), 200
-            return jsonify(reply="🔒 Please type the access password to begin."), 200
+        if len(images) > MAX_IMAGES:
+            return json_reply(error=f"Please send at most {MAX_IMAGES} images per message."), 400
 
         # Build user content (vision + text)
         user_content = []
@@ -318,43 +313,19 @@ def chat():
             user_content = [{"type": "text", "text": "Please analyze the attached image problem."}]
 
         # Dynamic system lines
-        lv = (level or "").lower()
-        if lv == "apprentice":
-            level_line = "LEVEL=Apprentice. You may explain proactively (2–6 short sentences) and must include a guiding question or options."
-        elif lv == "rising hero":
-            level_line = "LEVEL=Rising Hero. Brief coaching allowed (≤2 short sentences) plus one guiding question or options. Total 1–3 sentences."
-        elif lv == "master":
-            level_line = "LEVEL=Master. No explanations unless asked. One concise guiding question only."
-        else:
-            level_line = ""
-
-        grade_line = f"GRADE={grade or 'unknown'} for tone. Use Grade Guide; simplify language for younger grades and increase rigor for older grades."
-        focus_line = (
-            f"Focus Anchor: {focus or '(infer from latest learner content)'} "
-            "Stay on this focus; do not switch topics unless the learner clearly starts a new problem or says 'new question/new problem'."
-        )
-
-        # Vision guard: MUST confirm read pairs first when images are present
-        vision_guard = ""
-        if images:
-            vision_guard = (
-                "VISION GUARD: An image is present. Your FIRST reply must ONLY restate the (x,y) pairs you can read "
-                "for any table/option you will discuss, in this exact compact format, without calculations: "
-                "\"Read pairs → A: (x1,y1); (x2,y2); (x3,y3) | B: ... | C: ... . Confirm Y/N?\" "
-                "If any value is uncertain, use '?' and ask the learner to type it. Do not proceed to math until the learner confirms."
-            )
+        level_line, max_out = LEVELS.get((level or "").lower(), LEVEL_DEFAULT)
+
+        grade_line   = GRADE_LINE.format(grade=grade or "unknown")
+        focus_line   = FOCUS_LINE.format(focus=focus or "(infer from latest learner content)")
+        vision_guard = VISION_GUARD if images else ""
 
         def add(msgs, role, content):
             if str(content or "").strip():
                 msgs.append({"role": role, "content": content})
 
-        messages = []
-        add(messages, "system", MATHMATE_PROMPT)
-        add(messages, "system", grade_line)
-        add(messages, "system", level_line)
-        add(messages, "system", focus_line)
-        add(messages, "system", vision_guard)
-        add(messages, "system", HARD_CONSTRAINT)
+        # per-turn lines go in one system message after the static prefix
+        messages = [*BASE_SYSTEM]
+        add(messages, "system", "\n".join(line for line in (grade_line, level_line, focus_line, vision_guard) if line))
 
         # short rolling history (text-only)
         for h in history[-6:]:
@@ -366,28 +337,28 @@ def chat():
         # current turn with vision
         messages.append({"role": "user", "content": user_content})
 
-        # --- size the reply by level so it doesn't cut off mid-list ---
-        if lv == "apprentice":
-            max_out = 260
-        elif lv == "rising hero":
-            max_out = 180
-        else:
-            max_out = 120  # master/default
-
-        completion = client.chat.completions.create(
-            model=MODEL,
-            temperature=0.0,   # reduce randomness—no invented numbers
-            frequency_penalty=0.5,
-            presence_penalty=0.2,
-            max_tokens=max_out,
-            messages=messages,
-        )
-        return jsonify(reply=completion.choices[0].message.content)
-
+        # temperature 0 makes replies repeatable, so identical prompts can reuse the last answer;
+        # image turns are huge to hash and rarely repeat, so they are never cached
+        key = None if images else reply_key(messages, max_out)
+        reply = cache_get(key)
+        if "text/event-stream" in request.headers.get("Accept", ""):
+            return Response(
+                stream_reply(key, messages, max_out, reply),
+                mimetype="text/event-stream",
+                headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+            )
+        if reply is None:
+            completion = complete(messages, max_out)
+            reply = completion.choices[0].message.content
+            cache_put(key, reply)
+        return json_reply(reply=reply)
+
+    except RequestEntityTooLarge as e:
+        return too_large(e)
     except Exception as e:
         err = f"{type(e).__name__}: {e}"
         app.logger.exception("Chat crashed: %s", err)
-        return jsonify(error=err if DEBUG else "Server error"), 500
+        return json_reply(error=err if DEBUG else "Server error"), 500
 
 # ---------- LOCAL RUN ----------
 if __name__ == "__main__":